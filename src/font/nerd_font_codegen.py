@@ -4,12 +4,15 @@ extract scaling rules and attributes for different codepoint ranges which it the
 codegens in to a Zig file with a function that switches over codepoints and returns the
 attributes and scaling rules.
 
-This does include an `eval` call! This is spooky, but we trust the nerd fonts code to
-be safe and not malicious or anything.
+The patch sets aren't quite plain literals (they use things like `range` and
+`self.args`), so rather than `eval`-ing the nerd fonts code we evaluate them with a
+tiny interpreter that only understands the handful of constructs they need.
 
 This script requires Python 3.12 or greater, requires that the `fontTools`
 python module is installed, and requires that the path to a copy of the
 SymbolsNerdFontMono font is passed as the first argument to the script.
+If the `numpy` python module is installed it's used to speed up coalescing
+large groups of codepoints in to ranges, but it's not required.
 """
 
 import ast
@@ -17,11 +20,16 @@ import sys
 import math
 from fontTools.ttLib import TTFont
 from fontTools.pens.boundsPen import BoundsPen
-from collections import defaultdict
+from collections.abc import Iterator
 from contextlib import suppress
+from itertools import chain
 from pathlib import Path
-from types import SimpleNamespace
-from typing import Literal, TypedDict, cast
+from typing import Any, Literal, TypedDict, cast
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 type PatchSetAttributes = dict[Literal["default"] | int, PatchSetAttributeEntry]
 type AttributeHash = tuple[
@@ -64,60 +72,98 @@ class PatchSet(TypedDict):
     Attributes: PatchSetAttributes
 
 
-class PatchSetExtractor(ast.NodeVisitor):
+# Values for the names and `self.args` flags referenced by the patch
+# set definitions that aren't assigned in `setup_patch_set` itself.
+PATCHER_NAMES: dict[str, Any] = {"box_keep": True}
+PATCHER_ARGS: dict[str, Any] = {"careful": True}
+
+
+def eval_patcher_expr(node: ast.expr) -> Any:
+    """Evaluate the small subset of Python expressions used by the patch sets."""
+    match node:
+        case ast.Constant(value=value):
+            return value
+        case ast.Dict(keys=keys, values=values) if None not in keys:
+            return {
+                eval_patcher_expr(cast("ast.expr", k)): eval_patcher_expr(v)
+                for k, v in zip(keys, values)
+            }
+        case ast.List(elts=elts):
+            return eval_patcher_elts(elts)
+        case ast.Tuple(elts=elts):
+            return tuple(eval_patcher_elts(elts))
+        case ast.UnaryOp(op=ast.USub(), operand=operand):
+            return -eval_patcher_expr(operand)
+        case ast.UnaryOp(op=ast.Not(), operand=operand):
+            return not eval_patcher_expr(operand)
+        case ast.BinOp(left=left, op=ast.Add(), right=right):
+            return eval_patcher_expr(left) + eval_patcher_expr(right)
+        case ast.BinOp(left=left, op=ast.Sub(), right=right):
+            return eval_patcher_expr(left) - eval_patcher_expr(right)
+        case ast.Call(func=ast.Name(id="range"), args=args, keywords=[]):
+            return range(*(eval_patcher_expr(arg) for arg in args))
+        case ast.Name(id=name) if name in PATCHER_NAMES:
+            return PATCHER_NAMES[name]
+        case ast.Attribute(
+            value=ast.Attribute(value=ast.Name(id="self"), attr="args"),
+            attr=arg,
+        ) if arg in PATCHER_ARGS:
+            return PATCHER_ARGS[arg]
+    msg = f"<cannot eval: {type(node).__name__}>"
+    raise ValueError(msg)
+
+
+def eval_patcher_elts(elts: list[ast.expr]) -> list[Any]:
+    """Evaluate the elements of a list or tuple, expanding starred elements."""
+    result: list[Any] = []
+    for elt in elts:
+        if isinstance(elt, ast.Starred):
+            result.extend(eval_patcher_expr(elt.value))
+        else:
+            result.append(eval_patcher_expr(elt))
+    return result
+
+
+class PatchSetExtractor:
     def __init__(self) -> None:
         self.symbol_table: dict[str, ast.expr] = {}
+        # Resolved values of symbol table expressions, keyed by node id.
+        self.resolved_symbols: dict[int, ResolvedSymbol] = {}
         self.patch_set_values: list[PatchSet] = []
 
-    def visit_ClassDef(self, node: ast.ClassDef) -> None:
-        if node.name != "font_patcher":
-            return
-        for item in node.body:
-            if isinstance(item, ast.FunctionDef) and item.name == "setup_patch_set":
-                self.visit_setup_patch_set(item)
-
     def visit_setup_patch_set(self, node: ast.FunctionDef) -> None:
-        # First pass: gather variable assignments
+        # `self.patch_set` is assigned after all of the variables it
+        # references, so a single pass in source order is enough.
         for stmt in node.body:
             match stmt:
                 case ast.Assign(targets=[ast.Name(id=symbol)]):
                     # Store simple variable assignments in the symbol table
                     self.symbol_table[symbol] = stmt.value
-
-        # Second pass: process self.patch_set
-        for stmt in node.body:
-            if not isinstance(stmt, ast.Assign):
-                continue
-            for target in stmt.targets:
-                if (
-                    isinstance(target, ast.Attribute)
-                    and target.attr == "patch_set"
-                    and isinstance(stmt.value, ast.List)
+                case ast.Assign(targets=targets, value=ast.List(elts=elts)) if any(
+                    isinstance(target, ast.Attribute) and target.attr == "patch_set"
+                    for target in targets
                 ):
-                    for elt in stmt.value.elts:
+                    for elt in elts:
                         if isinstance(elt, ast.Dict):
                             self.process_patch_entry(elt)
 
     def resolve_symbol(self, node: ast.expr) -> ResolvedSymbol:
         """Resolve named variables to their actual values from the symbol table."""
         if isinstance(node, ast.Name) and node.id in self.symbol_table:
-            return self.safe_literal_eval(self.symbol_table[node.id])
+            # The same variables are referenced by many patch sets, so only
+            # evaluate each one once. This is done lazily rather than for
+            # the whole symbol table up front because some variables (e.g.
+            # `box_enabled`) can't be evaluated outside of the patcher.
+            value = self.symbol_table[node.id]
+            key = id(value)
+            if key not in self.resolved_symbols:
+                self.resolved_symbols[key] = self.safe_literal_eval(value)
+            return self.resolved_symbols[key]
         return self.safe_literal_eval(node)
 
     def safe_literal_eval(self, node: ast.expr) -> ResolvedSymbol:
-        """Try to evaluate or stringify an AST node."""
-        try:
-            return ast.literal_eval(node)
-        except ValueError:
-            # Spooky eval! But we trust nerd fonts to be safe...
-            if hasattr(ast, "unparse"):
-                return eval(
-                    ast.unparse(node),
-                    {"box_keep": True},
-                    {"self": SimpleNamespace(args=SimpleNamespace(careful=True))},
-                )
-            msg = f"<cannot eval: {type(node).__name__}>"
-            raise ValueError(msg) from None
+        """Evaluate an AST node from the patch set definitions."""
+        return eval_patcher_expr(node)
 
     def process_patch_entry(self, dict_node: ast.Dict) -> None:
         entry = {}
@@ -127,25 +173,34 @@ class PatchSetExtractor(ast.NodeVisitor):
                 isinstance(key_node, ast.Constant)
                 and key_node.value not in disallowed_key_nodes
             ):
-                key = ast.literal_eval(cast("ast.Constant", key_node))
-                entry[key] = self.resolve_symbol(value_node)
+                entry[key_node.value] = self.resolve_symbol(value_node)
         self.patch_set_values.append(cast("PatchSet", entry))
 
 
 def extract_patch_set_values(source_code: str) -> list[PatchSet]:
     tree = ast.parse(source_code)
     extractor = PatchSetExtractor()
-    extractor.visit(tree)
+    # We only care about one method of one top-level class, so look for it
+    # directly instead of walking the whole (large) patcher script.
+    for node in tree.body:
+        if not (isinstance(node, ast.ClassDef) and node.name == "font_patcher"):
+            continue
+        for item in node.body:
+            if isinstance(item, ast.FunctionDef) and item.name == "setup_patch_set":
+                extractor.visit_setup_patch_set(item)
     return extractor.patch_set_values
 
 
+ALIGNMENTS: dict[str, str | None] = {
+    "l": ".start",
+    "r": ".end",
+    "c": ".center",
+    "": None,
+}
+
+
 def parse_alignment(val: str) -> str | None:
-    return {
-        "l": ".start",
-        "r": ".end",
-        "c": ".center",
-        "": None,
-    }.get(val, ".none")
+    return ALIGNMENTS.get(val, ".none")
 
 
 def attr_key(attr: PatchSetAttributeEntry) -> AttributeHash:
@@ -165,8 +220,20 @@ def attr_key(attr: PatchSetAttributeEntry) -> AttributeHash:
     )
 
 
+# Below this many codepoints the overhead of going through numpy
+# outweighs the cost of just walking the list in Python.
+NUMPY_COALESCE_THRESHOLD = 32
+
+
 def coalesce_codepoints_to_ranges(codepoints: list[int]) -> list[tuple[int, int]]:
     """Convert a sorted list of integers to a list of single values and ranges."""
+    if np is not None and len(codepoints) >= NUMPY_COALESCE_THRESHOLD:
+        a = np.fromiter(sorted(codepoints), dtype=np.int32, count=len(codepoints))
+        breaks = np.nonzero(np.diff(a) != 1)[0]
+        starts = np.concatenate(([0], breaks + 1))
+        ends = np.concatenate((breaks, [len(a) - 1]))
+        return list(zip(a[starts].tolist(), a[ends].tolist()))
+
     ranges: list[tuple[int, int]] = []
     cp_iter = iter(sorted(codepoints))
     with suppress(StopIteration):
@@ -181,6 +248,29 @@ def coalesce_codepoints_to_ranges(codepoints: list[int]) -> list[tuple[int, int]
     return ranges
 
 
+# These translations don't quite capture the way
+# the actual patcher does scaling, but they're a
+# good enough compromise. The first stretch flag
+# found in this order picks the sizing.
+SIZE_STRETCH = (
+    "            .size_horizontal = .stretch,\n"
+    "            .size_vertical = .stretch,\n"
+)
+SIZE_COVER_FIT = (
+    "            .size_horizontal = .cover,\n"
+    "            .size_vertical = .fit,\n"
+)
+SIZE_FIT = (
+    "            .size_horizontal = .fit,\n"
+    "            .size_vertical = .fit,\n"
+)
+SIZE_BY_STRETCH = {
+    "xy": SIZE_STRETCH,
+    "!": SIZE_COVER_FIT,
+    "^": SIZE_COVER_FIT,
+}
+
+
 def emit_zig_entry_multikey(codepoints: list[int], attr: PatchSetAttributeEntry) -> str:
     align = parse_alignment(attr.get("align", ""))
     valign = parse_alignment(attr.get("valign", ""))
@@ -196,78 +286,70 @@ def emit_zig_entry_multikey(codepoints: list[int], attr: PatchSetAttributeEntry)
     xy_ratio = params.get("xy-ratio", -1.0)
     y_padding = params.get("ypadding", 0.0)
 
-    ranges = coalesce_codepoints_to_ranges(codepoints)
-    keys = "\n".join(
-        f"        {start:#x}...{end:#x}," if start != end else f"        {start:#x},"
-        for start, end in ranges
+    parts: list[str] = [
+        f"        {start:#x}...{end:#x},\n" if start != end else f"        {start:#x},\n"
+        for start, end in coalesce_codepoints_to_ranges(codepoints)
+    ]
+    parts.append("        => .{\n")
+
+    parts.append(
+        next(
+            (v for k, v in SIZE_BY_STRETCH.items() if k in stretch),
+            SIZE_FIT,
+        )
     )
 
-    s = f"{keys}\n        => .{{\n"
-
-    # These translations don't quite capture the way
-    # the actual patcher does scaling, but they're a
-    # good enough compromise.
-    if "xy" in stretch:
-        s += "            .size_horizontal = .stretch,\n"
-        s += "            .size_vertical = .stretch,\n"
-    elif "!" in stretch or "^" in stretch:
-        s += "            .size_horizontal = .cover,\n"
-        s += "            .size_vertical = .fit,\n"
-    else:
-        s += "            .size_horizontal = .fit,\n"
-        s += "            .size_vertical = .fit,\n"
-
     # `^` indicates that scaling should fill
     # the whole cell, not just the icon height.
     if "^" not in stretch:
-        s += "            .height = .icon,\n"
+        parts.append("            .height = .icon,\n")
 
     # There are two cases where we want to limit the constraint width to 1:
     # - If there's a `1` in the stretch mode string.
     # - If the stretch mode is `xy` and there's not an explicit `2`.
     if "1" in stretch or ("xy" in stretch and "2" not in stretch):
-        s += "            .max_constraint_width = 1,\n"
+        parts.append("            .max_constraint_width = 1,\n")
 
     if align is not None:
-        s += f"            .align_horizontal = {align},\n"
+        parts.append(f"            .align_horizontal = {align},\n")
     if valign is not None:
-        s += f"            .align_vertical = {valign},\n"
+        parts.append(f"            .align_vertical = {valign},\n")
 
     if group_width != 1.0:
-        s += f"            .group_width = {group_width:.16f},\n"
+        parts.append(f"            .group_width = {group_width:.16f},\n")
     if group_height != 1.0:
-        s += f"            .group_height = {group_height:.16f},\n"
+        parts.append(f"            .group_height = {group_height:.16f},\n")
     if group_x != 0.0:
-        s += f"            .group_x = {group_x:.16f},\n"
+        parts.append(f"            .group_x = {group_x:.16f},\n")
     if group_y != 0.0:
-        s += f"            .group_y = {group_y:.16f},\n"
+        parts.append(f"            .group_y = {group_y:.16f},\n")
 
     # `overlap` and `ypadding` are mutually exclusive,
     # this is asserted in the nerd fonts patcher itself.
     if overlap:
         pad = -overlap
-        s += f"            .pad_left = {pad},\n"
-        s += f"            .pad_right = {pad},\n"
+        parts.append(f"            .pad_left = {pad},\n")
+        parts.append(f"            .pad_right = {pad},\n")
         # In the nerd fonts patcher, overlap values
         # are capped at 0.01 in the vertical direction.
         v_pad = -min(0.01, overlap)
-        s += f"            .pad_top = {v_pad},\n"
-        s += f"            .pad_bottom = {v_pad},\n"
+        parts.append(f"            .pad_top = {v_pad},\n")
+        parts.append(f"            .pad_bottom = {v_pad},\n")
     elif y_padding:
-        s += f"            .pad_top = {y_padding / 2},\n"
-        s += f"            .pad_bottom = {y_padding / 2},\n"
+        parts.append(f"            .pad_top = {y_padding / 2},\n")
+        parts.append(f"            .pad_bottom = {y_padding / 2},\n")
 
     if xy_ratio > 0:
-        s += f"            .max_xy_ratio = {xy_ratio},\n"
+        parts.append(f"            .max_xy_ratio = {xy_ratio},\n")
 
-    s += "        },"
-    return s
+    parts.append("        },")
+    return "".join(parts)
 
 
 def generate_zig_switch_arms(
     patch_sets: list[PatchSet],
     nerd_font: TTFont,
-) -> str:
+) -> Iterator[str]:
     cmap = nerd_font.getBestCmap()
     glyphs = nerd_font.getGlyphSet()
 
@@ -275,10 +357,15 @@ def generate_zig_switch_arms(
     for entry in patch_sets:
         attributes = entry["Attributes"]
 
-        for cp in range(entry["SymStart"], entry["SymEnd"] + 1):
-            entries[cp] = attributes["default"].copy()
+        # Every codepoint in the range shares the same default attributes;
+        # entries are copied before being modified for scale groups below.
+        start, end = entry["SymStart"], entry["SymEnd"]
+        entries.update(dict.fromkeys(range(start, end + 1), attributes["default"]))
 
-        entries |= {k: v for k, v in attributes.items() if isinstance(k, int)}
+        # Per-codepoint overrides; the only other key is "default".
+        for k, v in attributes.items():
+            if type(k) is int:
+                entries[k] = v
 
         if entry["ScaleRules"] is not None and "ScaleGroups" in entry["ScaleRules"]:
             for group in entry["ScaleRules"]["ScaleGroups"]:
@@ -306,26 +393,64 @@ def generate_zig_switch_arms(
                     this_bounds = individual_bounds[cp]
                     this_width = this_bounds[2] - this_bounds[0]
                     this_height = this_bounds[3] - this_bounds[1]
-                    entries[cp]["group_width"] = group_width / this_width
-                    entries[cp]["group_height"] = group_height / this_height
-                    entries[cp]["group_x"] = (this_bounds[0] - xMin) / group_width
-                    entries[cp]["group_y"] = (this_bounds[1] - yMin) / group_height
+                    attr = entries[cp] = entries[cp].copy()
+                    attr["group_width"] = group_width / this_width
+                    attr["group_height"] = group_height / this_height
+                    attr["group_x"] = (this_bounds[0] - xMin) / group_width
+                    attr["group_y"] = (this_bounds[1] - yMin) / group_height
 
     del entries[0]
 
-    # Group codepoints by attribute key
-    grouped = defaultdict[AttributeHash, list[int]](list)
+    # Group codepoints by attribute key, keeping one of the attrs in each
+    # group alongside it to emit the value with.
+    #
+    # Most codepoints share the same attributes object, so the key is only
+    # computed once per object. (The objects are all kept alive by `entries`,
+    # so their ids are stable.) Codepoints are also visited range by range
+    # and come in long runs with the same attributes object, so for a run we
+    # just keep appending to the last group.
+    grouped: dict[AttributeHash, tuple[list[int], PatchSetAttributeEntry]] = {}
+    key_cache: dict[int, AttributeHash] = {}
+    last_attr: PatchSetAttributeEntry | None = None
+    last_group: list[int] = []
     for cp, attr in entries.items():
-        grouped[attr_key(attr)].append(cp)
+        if attr is not last_attr:
+            key = key_cache.get(id(attr))
+            if key is None:
+                key = key_cache[id(attr)] = attr_key(attr)
+            group = grouped.get(key)
+            if group is None:
+                group = grouped[key] = ([], attr)
+            last_group, _ = group
+            last_attr = attr
+        last_group.append(cp)
+
+    # The groups hold on to every attr we need, let the rest go.
+    del entries, key_cache
 
     # Emit zig switch arms
-    result: list[str] = []
-    for codepoints in sorted(grouped.values()):
-        # Use one of the attrs in the group to emit the value
-        attr = entries[codepoints[0]]
-        result.append(emit_zig_entry_multikey(codepoints, attr))
+    for codepoints, attr in sorted(grouped.values(), key=lambda group: group[0]):
+        yield emit_zig_entry_multikey(codepoints, attr)
+        yield "\n"
+
+
+ZIG_HEADER = """//! This is a generated file, produced by nerd_font_codegen.py
+//! DO NOT EDIT BY HAND!
+//!
+//! This file provides info extracted from the nerd fonts patcher script,
+//! specifying the scaling/positioning attributes of various glyphs.
+
+const Constraint = @import("face.zig").RenderOptions.Constraint;
+
+/// Get the a constraints for the provided codepoint.
+pub fn getConstraint(cp: u21) Constraint {
+    return switch (cp) {
+"""
 
-    return "\n".join(result)
+ZIG_FOOTER = """        else => .none,
+    };
+}
+"""
 
 
 if __name__ == "__main__":
@@ -342,17 +467,10 @@ if __name__ == "__main__":
     out_path = project_root / "src" / "font" / "nerd_font_attributes.zig"
 
     with out_path.open("w", encoding="utf-8") as f:
-        f.write("""//! This is a generated file, produced by nerd_font_codegen.py
-//! DO NOT EDIT BY HAND!
-//!
-//! This file provides info extracted from the nerd fonts patcher script,
-//! specifying the scaling/positioning attributes of various glyphs.
-
-const Constraint = @import("face.zig").RenderOptions.Constraint;
-
-/// Get the a constraints for the provided codepoint.
-pub fn getConstraint(cp: u21) Constraint {
-    return switch (cp) {
-""")
-        f.write(generate_zig_switch_arms(patch_set, nerd_font))
-        f.write("\n        else => .none,\n    };\n}\n")
+        f.writelines(
+            chain(
+                [ZIG_HEADER],
+                generate_zig_switch_arms(patch_set, nerd_font),
+                [ZIG_FOOTER],
+            )
+        )